@@ -1,27 +1,52 @@
 import argparse
+import concurrent.futures
+import dataclasses
+import functools
 import gzip
 import logging
 import math
+import multiprocessing
 import numpy as np
 import os
-import pandas as pd
 
 import time
 import torch
+
+# read once when CUDA is initialized, which already happens when unicore is imported;
+# expandable_segments is only understood from torch 2.1 on
+if torch.__version__ >= "2.1":
+    os.environ.setdefault(
+        "PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512"
+    )
+else:
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "max_split_size_mb:512")
+
 import json
 import pickle
 from unifold.config import model_config
 from unifold.modules.alphafold import AlphaFold
 from unifold.data import residue_constants, protein
-from unifold.dataset import load_and_process, UnifoldDataset
+from unifold.dataset import (
+    load,
+    process,
+    subsample_msa_to_neff,
+    dropout_crosslinked_msa,
+    UnifoldDataset,
+)
+from unicore.data import data_utils
 from unicore.utils import (
     tensor_tree_map,
 )
-from unifold.data.data_ops import get_pairwise_distances
 from unifold.data import residue_constants as rc
 
 from alphafold.relax import relax
 
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
 # from https://github.com/deepmind/alphafold/blob/main/run_alphafold.py
 
 RELAX_MAX_ITERATIONS = 0
@@ -31,6 +56,7 @@ RELAX_EXCLUDE_RESIDUES = []
 RELAX_MAX_OUTER_ITERATIONS = 3
 
 
+@functools.lru_cache(maxsize=4)
 def get_device_mem(device):
     if device != "cpu" and torch.cuda.is_available():
         cur_device = torch.cuda.current_device()
@@ -40,7 +66,41 @@ def get_device_mem(device):
     else:
         return 40
 
-def automatic_chunk_size(seq_len, device, is_bf16):
+# rough activation cost model used to size chunks for the longest sequences,
+# deliberately on the large side; the OOM retry in main() halves the chunk size
+# if it still doesn't fit. The model dimensions come from config.model.
+RESIDENT_PAIR_COPIES = 6  # pair representation and the temporaries living next to it
+USABLE_MEM_FRACTION = 0.9
+
+def max_fitting_chunk_size(
+    seq_len, total_mem_in_GB, is_bf16, pair_dim, num_heads, opm_dim, min_chunk=4, max_chunk=16,
+):
+    """Largest power of two chunk size whose chunked layers fit next to the pair activations.
+
+    A chunk of the msa row or triangle attention (``num_heads`` being the
+    largest head count of the two) holds two tensors of
+    ``chunk * num_heads * seq_len ** 2`` elements (the logits and the softmax
+    output, or the merged mask and bias and the kernel workspace with SDPA),
+    and a chunk of the outer product mean holds ``chunk * seq_len * opm_dim ** 2``
+    fp32 elements, while roughly ``RESIDENT_PAIR_COPIES`` fp32 pair-sized tensors
+    of ``pair_dim`` channels stay resident (the residual streams are not
+    downcast under autocast). ``max_chunk`` keeps the result below the chunk
+    size of the shorter sequences.
+    """
+    bytes_per_elem = 2 if is_bf16 else 4
+    pair_bytes = seq_len * seq_len * pair_dim * 4
+    chunk_row_bytes = (
+        2 * num_heads * seq_len * seq_len * bytes_per_elem
+        + seq_len * opm_dim * opm_dim * 4
+    )
+    budget = total_mem_in_GB * 1024 ** 3 * USABLE_MEM_FRACTION - RESIDENT_PAIR_COPIES * pair_bytes
+    chunk_size = min_chunk
+    while chunk_size * 2 <= max_chunk and chunk_size * 2 * chunk_row_bytes <= budget:
+        chunk_size *= 2
+    return chunk_size
+
+@functools.lru_cache(maxsize=4)
+def automatic_chunk_size(seq_len, device, is_bf16, pair_dim, num_heads, opm_dim):
     total_mem_in_GB = get_device_mem(device)
     factor = math.sqrt(total_mem_in_GB/40.0*(0.55 * is_bf16 + 0.45))*0.95
     if seq_len < int(1024*factor):
@@ -56,13 +116,49 @@ def automatic_chunk_size(seq_len, device, is_bf16):
         chunk_size = 32
         block_size = 512
     else:
-        chunk_size = 4
+        chunk_size = max_fitting_chunk_size(
+            seq_len, total_mem_in_GB, is_bf16, pair_dim, num_heads, opm_dim
+        )
         block_size = 256
     return chunk_size, block_size
 
+def to_float(x):
+    if x.dtype == torch.bfloat16 or x.dtype == torch.half:
+        return x.float()
+    else:
+        return x
+
+def is_out_of_memory(e):
+    # torch.cuda.OutOfMemoryError only exists from torch 1.13 on and subclasses RuntimeError
+    return isinstance(e, RuntimeError) and "out of memory" in str(e)
+
+def is_low_precision(tree):
+    if isinstance(tree, dict):
+        return any(is_low_precision(v) for v in tree.values())
+    elif isinstance(tree, (list, tuple)):
+        return any(is_low_precision(v) for v in tree)
+    else:
+        return tree.dtype == torch.bfloat16 or tree.dtype == torch.half
+
+def quantize_model(model, method):
+    """Quantize the linear layers of ``model`` in place with torchao."""
+    from torchao.quantization import (
+        quantize_,
+        Int8WeightOnlyConfig,
+        Float8WeightOnlyConfig,
+    )
+    if method == "int8wo":
+        quantize_(model, Int8WeightOnlyConfig())
+    elif method == "fp8":
+        quantize_(model, Float8WeightOnlyConfig())
+    else:
+        raise ValueError(f"Unknown quantization method: {method}")
+    return model
+
 def load_feature_for_one_target(
-    config, data_folder, crosslinks, seed=0, is_multimer=False, use_uniprot=False, neff=-1, dropout_crosslinks=-1,
+    data_folder, crosslinks, is_multimer=False, use_uniprot=False,
 ):
+    """Load the seed independent features (MSAs, templates, crosslinks) of a target."""
     if not is_multimer:
         uniprot_msa_dir = None
         sequence_ids = ["A"]
@@ -71,41 +167,196 @@ def load_feature_for_one_target(
 
     else:
         uniprot_msa_dir = data_folder
-        sequence_ids = open(os.path.join(data_folder, "chains.txt")).readline().split() # A B C?
-    batch, _ = load_and_process(
+        with open(os.path.join(data_folder, "chains.txt")) as f:
+            sequence_ids = f.readline().split() # A B C?
+    features, _ = load(
+        sequence_ids=sequence_ids,
+        monomer_feature_dir=data_folder,
+        crosslinks=crosslinks,
+        mode="predict",
+        uniprot_msa_dir=uniprot_msa_dir,
+        is_monomer=(not is_multimer),
+    )
+    return features
+
+def process_feature_for_one_seed(
+    config, features, seed=0, neff=-1, dropout_crosslinks=-1,
+):
+    """Build the model input for one seed from the features of load_feature_for_one_target."""
+    features = dict(features)
+    if neff > 0:
+        with data_utils.numpy_seed(seed, key="neff"):
+            features = subsample_msa_to_neff(features, neff)
+    if dropout_crosslinks > 0:
+        features["msa"] = features["msa"].copy()
+        features["deletion_matrix"] = features["deletion_matrix"].copy()
+        features = dropout_crosslinked_msa(features)
+    batch, _ = process(
         config=config.data,
         mode="predict",
+        features=features,
         seed=seed,
         batch_idx=None,
         data_idx=0,
         is_distillation=False,
-        sequence_ids=sequence_ids,
-        monomer_feature_dir=data_folder,
-        uniprot_msa_dir=uniprot_msa_dir,
-        is_monomer=(not is_multimer),
-        crosslinks=crosslinks,
-        neff=neff,
-        dropout_crosslinks=dropout_crosslinks,
     )
     batch = UnifoldDataset.collater([batch])
     return batch
+
+def prepare_batch_for_one_seed(
+    config, features, seed, device, copy_stream=None, neff=-1, dropout_crosslinks=-1,
+):
+    """Process the features of one seed and copy the batch to ``device``.
+
+    Meant to run on a background thread while the previous seed is in the
+    forward pass. With ``copy_stream``, the copies are issued on that stream so
+    they overlap with the compute stream; the returned event has to be waited
+    on before the batch is used, otherwise it is None.
+    """
+    batch = process_feature_for_one_seed(
+        config, features, seed, neff=neff, dropout_crosslinks=dropout_crosslinks,
+    )
+    if copy_stream is None:
+        return {k: torch.as_tensor(v, device=device) for k, v in batch.items()}, None
+    with torch.cuda.stream(copy_stream):
+        # pinned so the copies are asynchronous, staging happens on this thread
+        batch = {
+            k: torch.as_tensor(v).pin_memory().to(device, non_blocking=True)
+            for k, v in batch.items()
+        }
+    return batch, copy_stream.record_event()
+
+
+def save_prediction(pdb_path, prot, raw_output=None):
+    """Write ``prot`` to ``pdb_path`` and, if given, the pickled raw model output next to it."""
+    with open(pdb_path, "w") as f:
+        f.write(protein.to_pdb(prot))
+    if raw_output is not None:
+        # the raw output can be hundreds of MB, trade some size for much less CPU time
+        with gzip.open(pdb_path + '_outputs.pkl.gz', 'wb', compresslevel=1) as f:
+            pickle.dump(raw_output, f)
+
+
+def relax_prediction(prot, use_gpu):
+    """Amber-relax ``prot`` and return the relaxed PDB string."""
+    amber_relaxer = relax.AmberRelaxation(
+        max_iterations=RELAX_MAX_ITERATIONS,
+        tolerance=RELAX_ENERGY_TOLERANCE,
+        stiffness=RELAX_STIFFNESS,
+        exclude_residues=RELAX_EXCLUDE_RESIDUES,
+        max_outer_iterations=RELAX_MAX_OUTER_ITERATIONS,
+        use_gpu=use_gpu)
+    relaxed_pdb_str, _, _ = amber_relaxer.process(prot=prot)
+    return relaxed_pdb_str
+
+
+@dataclasses.dataclass(frozen=True)
+class RDCs:
+    """RDC restraints with atom names resolved to atom37 indices."""
+    res_idx: np.ndarray  # [N] 0-based residue index
+    a1_idx: np.ndarray  # [N] atom37 index of the first atom
+    a2_idx: np.ndarray  # [N] atom37 index of the second atom
+    values: np.ndarray  # [N] measured couplings
+
+
 def load_rdc_file(path):
     """Load a tab-delimited RDC file with columns: residue, atom1, atom2, value."""
+    res_idx, a1_idx, a2_idx, values = [], [], [], []
     try:
-        df = pd.read_csv(path, sep="\t", header=None, names=["residue", "atom1", "atom2", "value"])
-        return df
-    except Exception as e:
+        with open(path) as f:
+            for line in f:
+                fields = [x.strip() for x in line.split("\t")]
+                if len(fields) < 4:
+                    continue
+                residue, atom1, atom2, value = fields[:4]
+                # rows with unknown atoms or missing values are dropped
+                if atom1 not in rc.atom_order or atom2 not in rc.atom_order:
+                    continue
+                try:
+                    residue = int(residue)
+                    value = float(value)
+                except ValueError:
+                    continue
+                if math.isnan(value):
+                    continue
+                res_idx.append(residue - 1)  # 1-based in file
+                a1_idx.append(rc.atom_order[atom1])
+                a2_idx.append(rc.atom_order[atom2])
+                values.append(value)
+    except OSError as e:
         raise ValueError(f"Failed to read RDC file: {path}\n{e}")
+    return RDCs(
+        res_idx=np.array(res_idx, dtype=np.int64),
+        a1_idx=np.array(a1_idx, dtype=np.int64),
+        a2_idx=np.array(a2_idx, dtype=np.int64),
+        values=np.array(values, dtype=np.float64),
+    )
+
+
+if HAS_NUMBA:
+
+    @njit(cache=True, fastmath=True, boundscheck=False, error_model="numpy")
+    def _q_factor_kernel(coords, res_idx, a1_idx, a2_idx, values):
+        num_res = coords.shape[0]
+        num_valid = 0
+        sum_diff2 = 0.0
+        sum_val2 = 0.0
+        for i in range(res_idx.shape[0]):
+            r = res_idx[i]
+            if r < 0 or r >= num_res:
+                continue
+            dx = coords[r, a2_idx[i], 0] - coords[r, a1_idx[i], 0]
+            dy = coords[r, a2_idx[i], 1] - coords[r, a1_idx[i], 1]
+            dz = coords[r, a2_idx[i], 2] - coords[r, a1_idx[i], 2]
+            norm2 = dx * dx + dy * dy + dz * dz
+            if norm2 == 0.0:
+                continue  # coincident atoms have no bond direction
+            diff = dz * dz / norm2 - values[i]
+            sum_diff2 += diff * diff
+            sum_val2 += values[i] * values[i]
+            num_valid += 1
+        if num_valid == 0 or sum_val2 == 0.0:
+            return np.inf
+        return np.sqrt(sum_diff2 / sum_val2)
+
+    def _warm_up_q_factor_kernel():
+        # compile for the float32 model outputs now rather than inside the first model evaluation
+        dummy_coords = np.zeros((1, rc.atom_type_num, 3), dtype=np.float32)
+        dummy_coords[0, 1, 2] = 1.0
+        _q_factor_kernel(
+            dummy_coords,
+            np.zeros(1, dtype=np.int64),
+            np.zeros(1, dtype=np.int64),
+            np.ones(1, dtype=np.int64),
+            np.ones(1, dtype=np.float64),
+        )
+
+
+def compute_q_factor(coords, rdcs):
+    """RDC Q factor of atom37 coordinates [N_res, 37, 3], assuming alignment along z."""
+    if HAS_NUMBA:
+        return _q_factor_kernel(
+            np.ascontiguousarray(coords), rdcs.res_idx, rdcs.a1_idx, rdcs.a2_idx, rdcs.values
+        )
+    valid = (rdcs.res_idx >= 0) & (rdcs.res_idx < coords.shape[0])
+    res_idx = rdcs.res_idx[valid]
+    v = coords[res_idx, rdcs.a2_idx[valid]] - coords[res_idx, rdcs.a1_idx[valid]]
+    norm2 = (v * v).sum(-1)
+    nonzero = norm2 > 0  # coincident atoms have no bond direction
+    values = rdcs.values[valid][nonzero]
+    if not nonzero.any() or not values.any():
+        return np.inf  # prevent selecting if no RDCs match
+    pred = v[nonzero, 2] ** 2 / norm2[nonzero]  # simple dipolar model (scaled out)
+    return np.linalg.norm(pred - values) / np.linalg.norm(values)
+
 
 def main(args):
-    rdc_df = None
-    use_rdcs = args.rdc_path is not None
-    if use_rdcs:
-        try:
-            print(f"Loading RDCs from {args.rdc_path}")
-            rdc_df = load_rdc_file(args.rdc_path)
-        except Exception as e:
-            raise ValueError(f"Failed to read RDC file: {args.rdc_path}\n{e}")
+    rdcs = None
+    if args.rdc_path is not None:
+        print(f"Loading RDCs from {args.rdc_path}")
+        rdcs = load_rdc_file(args.rdc_path)
+        if HAS_NUMBA:
+            _warm_up_q_factor_kernel()
     config = model_config(args.model_name)
     config.data.common.max_recycling_iters = args.max_recycling_iters
     config.globals.max_recycling_iters = args.max_recycling_iters
@@ -123,13 +374,25 @@ def main(args):
     model = model.to(args.model_device)
     model.eval()
     model.inference_mode()
-    if args.bf16:
-        model.bfloat16()
+    # with --bf16 the weights stay in fp32 and the forward pass runs under autocast
+    forward = model
+    if args.quantize in ("int8wo", "fp8"):
+        quantize_model(model, args.quantize)
+    if args.quantize == "autoquant":
+        import torchao
+        # kernels are benchmarked and picked per layer during the first prediction
+        forward = torchao.autoquant(torch.compile(model, mode="max-autotune"))
+    elif args.compile:
+        # every seed of a target has the same input shapes, so one graph is reused
+        torch._dynamo.config.cache_size_limit = 64
+        # fall back to eager for anything dynamo fails to compile
+        torch._dynamo.config.suppress_errors = True
+        forward = torch.compile(model, dynamic=False, mode="reduce-overhead")
 
     # data path is based on target_name
     data_dir = args.data_dir #os.path.join(args.data_dir, args.target_name)
     output_dir = args.output_dir #os.path.join(args.output_dir, args.target_name)
-    os.system("mkdir -p {}".format(output_dir))
+    os.makedirs(output_dir, exist_ok=True)
     cur_param_path_postfix = os.path.split(args.param_path)[-1]
     name_postfix = ""
     if args.sample_templates:
@@ -145,55 +408,130 @@ def main(args):
     plddts = {}
     ptms = {}
 
-    cur_seed = hash((args.data_random_seed, 0)) % 100000
-
-    seed = 0
     best_out = None
     best_iptm = 0.0
     best_seed = None
 
-    for it in range(args.times):
-        cur_seed = hash((args.data_random_seed, seed)) % 100000
-
-        batch = load_feature_for_one_target(
+    # with several samples, relax each new best model on CPU while the GPU keeps predicting
+    relax_pool = None
+    relax_job = None  # (protein, async result) of the one relaxation in flight
+    best_relax_protein = None
+    if args.relax and args.times > 1:
+        # spawn/forkserver workers would re-import this script and unicore, creating
+        # a CUDA context per worker. Forked workers only run OpenMM on CPU and never
+        # touch the inherited CUDA state; Pool forks its worker right here, before the
+        # prefetch and writer threads exist, so no lock held by another thread is
+        # inherited. Unlike ProcessPoolExecutor, a Pool can be terminated while a
+        # stale relaxation is still running.
+        relax_pool = multiprocessing.get_context("fork").Pool(processes=1)
+    # with --save_all_models, serialize outputs in the background while the next model runs
+    writer = None
+    pending_writes = []
+    if args.save_all_models:
+        writer = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+    # only the MSA subsampling and feature processing depend on the seed
+    features = load_feature_for_one_target(
+        data_dir,
+        args.crosslinks,
+        is_multimer=is_multimer,
+        use_uniprot=args.use_uniprot,
+    )
+    seq_len = int(features["seq_length"])
+    # faster prediction with large chunk/block size
+    # under autocast the chunked attention logits are bf16; the OOM retry below
+    # shrinks the chunks if the fp32 residual streams don't leave enough room
+    evoformer_config = config.model.evoformer_stack
+    chunk_size, block_size = automatic_chunk_size(
+                                seq_len,
+                                args.model_device,
+                                args.bf16,
+                                evoformer_config.d_pair,
+                                max(
+                                    evoformer_config.num_heads_msa,
+                                    evoformer_config.num_heads_pair,
+                                    config.model.extra_msa.extra_msa_stack.num_heads_msa,
+                                ),
+                                evoformer_config.d_hid_opm,
+                            )
+    model.globals.chunk_size = chunk_size
+    model.globals.block_size = block_size
+
+    low_precision_keys = None
+
+    # the next seed is processed and copied to the device while the current one runs
+    copy_stream = None
+    if torch.device(args.model_device).type == "cuda":
+        copy_stream = torch.cuda.Stream(device=args.model_device)
+    prefetcher = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def prefetch(it):
+        seed = hash((args.data_random_seed, it)) % 100000
+        return seed, prefetcher.submit(
+            prepare_batch_for_one_seed,
             config,
-            data_dir,
-            args.crosslinks,
-            cur_seed,
-            is_multimer=is_multimer,
-            use_uniprot=args.use_uniprot,
+            features,
+            seed,
+            args.model_device,
+            copy_stream,
             neff=args.neff,
             dropout_crosslinks=args.dropout_crosslinks,
         )
 
-        seed += 1
-        seq_len = batch["aatype"].shape[-1]
-        # faster prediction with large chunk/block size
-        chunk_size, block_size = automatic_chunk_size(
-                                    seq_len,
-                                    args.model_device,
-                                    args.bf16
-                                )
-        model.globals.chunk_size = chunk_size
-        model.globals.block_size = block_size
-
-        with torch.no_grad():
-            batch = {
-                k: torch.as_tensor(v, device=args.model_device)
-                for k, v in batch.items()
-            }
+    next_batch = prefetch(0)
+    for it in range(args.times):
+        cur_seed, pending_batch = next_batch
+        batch, batch_ready = pending_batch.result()
+        if it + 1 < args.times:
+            next_batch = prefetch(it + 1)
+        # relax the current best once the worker is idle; with at most one job in
+        # flight a new best never queues behind superseded ones
+        if (
+            relax_pool is not None
+            and best_relax_protein is not None
+            and (
+                relax_job is None
+                or (relax_job[0] is not best_relax_protein and relax_job[1].ready())
+            )
+        ):
+            relax_job = (
+                best_relax_protein,
+                relax_pool.apply_async(relax_prediction, (best_relax_protein, False)),
+            )
+
+        with torch.inference_mode(), torch.autocast(
+            device_type=torch.device(args.model_device).type,
+            dtype=torch.bfloat16,
+            enabled=args.bf16,
+        ):
+            if batch_ready is not None:
+                compute_stream = torch.cuda.current_stream()
+                compute_stream.wait_event(batch_ready)
+                # allocated on the copy stream, keep them alive for the compute stream
+                for v in batch.values():
+                    v.record_stream(compute_stream)
             shapes = {k: v.shape for k, v in batch.items()}
             # print(shapes)
             t = time.perf_counter()
-            raw_out = model(batch)
+            raw_out = None
+            while raw_out is None:
+                try:
+                    raw_out = forward(batch)
+                except RuntimeError as e:
+                    if not is_out_of_memory(e) or model.globals.chunk_size <= 4:
+                        raise
+                if raw_out is None:
+                    # retry with smaller chunks, and only give cached blocks back
+                    # to the driver when we actually ran out
+                    model.globals.chunk_size = max(4, model.globals.chunk_size // 2)
+                    print(
+                        "Out of memory, retrying with chunk size {}".format(
+                            model.globals.chunk_size
+                        )
+                    )
+                    torch.cuda.empty_cache()
             print(f"Inference time: {time.perf_counter() - t}")
 
-        def to_float(x):
-            if x.dtype == torch.bfloat16 or x.dtype == torch.half:
-                return x.float()
-            else:
-                return x
-
         if not args.save_raw_output:
             score = ["plddt", "ptm", "iptm", "iptm+ptm"]
             out = {
@@ -205,92 +543,53 @@ def main(args):
         del raw_out
         # Toss out the recycling dimensions --- we don't need them anymore
         batch = tensor_tree_map(lambda t: t[-1, 0, ...], batch)
-        batch = tensor_tree_map(to_float, batch)
         out = tensor_tree_map(lambda t: t[0, ...], out)
-        out = tensor_tree_map(to_float, out)
-        batch = tensor_tree_map(lambda x: np.array(x.cpu()), batch)
-        out = tensor_tree_map(lambda x: np.array(x.cpu()), out)
-
+        # inputs stay fp32, only outputs produced under autocast need casting back;
+        # which ones is the same for every seed, so they are looked up once
+        if low_precision_keys is None:
+            low_precision_keys = [k for k, v in out.items() if is_low_precision(v)]
+        for k in low_precision_keys:
+            out[k] = tensor_tree_map(to_float, out[k])
+
+        # score the model while the outputs are still on device
         ca_idx = rc.atom_order["CA"]
-        ca_coords = torch.from_numpy(out["final_atom_positions"][..., ca_idx, :])
+        ca_coords = out["final_atom_positions"][..., ca_idx, :]
         
-        if rdc_df is not None:
+        if rdcs is not None:
             # Use RDC Q-factor as selection metric
-            def compute_q_factor(pred_coords, rdc_df):
-                # Simplified: assumes atom1/atom2 are always N/H or other valid single-atom types
-                coords_np = pred_coords.detach().cpu().numpy()
-                diffs = []
-                values = []
-                for _, row in rdc_df.iterrows():
-                    res_idx = int(row["residue"]) - 1  # assuming 1-based indexing in file
-                    atom1 = row["atom1"]
-                    atom2 = row["atom2"]
-                    try:
-                        a1_idx = rc.atom_order[atom1]
-                        a2_idx = rc.atom_order[atom2]
-                        vec = coords_np[res_idx, a2_idx] - coords_np[res_idx, a1_idx]
-                        angle = vec[2] / np.linalg.norm(vec)  # assume alignment along z
-                        pred_rdc = angle**2  # simple dipolar model (scaled out)
-                        diffs.append(pred_rdc - row["value"])
-                        values.append(row["value"])
-                    except Exception as e:
-                        continue  # skip invalid atoms or missing values
-                diffs = np.array(diffs)
-                values = np.array(values)
-                if len(values) == 0:
-                    return np.inf  # prevent selecting if no RDCs match
-                q = np.sqrt(np.mean(diffs**2)) / np.sqrt(np.mean(values**2))
-                return q
-        
-            q_score = compute_q_factor(out["final_atom_positions"][..., :], rdc_df)
-            print(f"Model {it} RDC Q factor: {q_score:.4f} Model confidence: {np.mean(out['iptm+ptm']):.3f}")
-        
-            if best_out is None or q_score < best_q_score:
+            q_score = compute_q_factor(out["final_atom_positions"].cpu().numpy(), rdcs)
+            print(f"Model {it} RDC Q factor: {q_score:.4f} Model confidence: {out['iptm+ptm'].mean().item():.3f}")
+            is_best = best_out is None or q_score < best_q_score
+            if is_best:
                 best_q_score = q_score
-                best_out = out
-                best_seed = cur_seed
         
         else:
-            distances = get_pairwise_distances(ca_coords)
-            xl = torch.from_numpy(batch['xl'][...,0] > 0)
-            interface = torch.from_numpy(batch['asym_id'][..., None] != batch['asym_id'][..., None, :])
-            satisfied = torch.sum(distances[xl & interface] <= args.cutoff) / 2
-            total_xl = torch.sum(xl & interface) / 2
-            print("Model %d Crosslink satisfaction: %.3f Model confidence: %.3f" % (it, satisfied / total_xl, np.mean(out["iptm+ptm"])))
-        
-            if best_out is None or np.mean(out["iptm+ptm"]) > best_iptm:
-                best_iptm = np.mean(out["iptm+ptm"])
-                best_out = out
-                best_seed = cur_seed
-        
-
-
-
-#         distances = get_pairwise_distances(ca_coords)#[0]#[0,0]
-# 	# We may be add the RDCs here as a selection criteria
-        
-#         xl = torch.from_numpy(batch['xl'][...,0] > 0)
-        
-#         interface = torch.from_numpy(batch['asym_id'][..., None] != batch['asym_id'][..., None, :])
-
-#         satisfied = torch.sum(distances[xl & interface] <= args.cutoff) / 2
-
-#         total_xl = torch.sum(xl & interface) / 2
-
-#         if np.mean(out["iptm+ptm"]) > best_iptm:
-#             best_iptm = np.mean(out["iptm+ptm"])
-#             best_out = out
-#             best_seed = cur_seed
-
-#         print("Model %d Crosslink satisfaction: %.3f Model confidence: %.3f" %(it,satisfied / total_xl, np.mean(out["iptm+ptm"])))
+            # matmul based distances, accurate to well below the crosslink cutoff
+            distances = torch.cdist(ca_coords[None], ca_coords[None]).squeeze(0)
+            asym_id = batch['asym_id']
+            inter_xl = (batch['xl'][..., 0] > 0) & asym_id.unsqueeze(-1).ne(asym_id.unsqueeze(-2))
+            # masked sums instead of boolean indexing, which would sync on the gather size
+            satisfied = ((distances <= args.cutoff) & inter_xl).sum() / 2
+            total_xl = inter_xl.sum() / 2
+            iptm = out["iptm+ptm"].mean().item()
+            print("Model %d Crosslink satisfaction: %.3f Model confidence: %.3f" % (it, (satisfied / total_xl).item(), iptm))
+            is_best = best_out is None or iptm > best_iptm
+            if is_best:
+                best_iptm = iptm
+
+        # only the best model, or every model with --save_all_models, is copied to host
+        if not (is_best or args.save_all_models):
+            continue
+        batch = tensor_tree_map(lambda x: np.array(x.cpu()), batch)
+        out = tensor_tree_map(lambda x: np.array(x.cpu()), out)
 
         plddt = out["plddt"]
-        mean_plddt = np.mean(plddt)
-        plddt_b_factors = np.repeat(
-            plddt[..., None], residue_constants.atom_type_num, axis=-1
+        # read-only view, every atom of a residue gets the residue pLDDT
+        plddt_b_factors = np.broadcast_to(
+            plddt[..., None] * 100, plddt.shape + (residue_constants.atom_type_num,)
         )
         cur_protein = protein.from_prediction(
-            features=batch, result=out, b_factors=plddt_b_factors*100
+            features=batch, result=out, b_factors=plddt_b_factors
         )
 
         iptm_str = np.mean(out["iptm+ptm"])
@@ -299,26 +598,49 @@ def main(args):
             f"AlphaLink2_{cur_seed}_{iptm_str:.3f}.pdb"
         )
 
-        with open(os.path.join(output_dir, cur_save_name), "w") as f:
-            f.write(protein.to_pdb(cur_protein))
-
-
-        if args.save_raw_output:
-            with gzip.open(os.path.join(output_dir, cur_save_name + '_outputs.pkl.gz'), 'wb') as f:
-                pickle.dump(out, f)
-        # del out
+        if args.save_all_models:
+            pending_writes.append(writer.submit(
+                save_prediction,
+                os.path.join(output_dir, cur_save_name),
+                cur_protein,
+                out if args.save_raw_output else None,
+            ))
+        if is_best:
+            best_out = out
+            best_batch = batch
+            best_seed = cur_seed
+            best_protein = cur_protein
+            best_save_name = cur_save_name
+            if relax_pool is not None:
+                best_relax_protein = protein.from_prediction(
+                    features=batch,
+                    result=out,
+                    b_factors=np.broadcast_to(plddt[..., None], plddt_b_factors.shape),
+                )
+
+    if writer is not None:
+        for future in pending_writes:
+            future.result()
+        writer.shutdown()
+    else:
+        save_prediction(
+            os.path.join(output_dir, best_save_name),
+            best_protein,
+            best_out if args.save_raw_output else None,
+        )
+    prefetcher.shutdown()
 
 
     out = best_out
 
     plddt = out["plddt"]
     mean_plddt = np.mean(plddt)
-    plddt_b_factors = np.repeat(
-        plddt[..., None], residue_constants.atom_type_num, axis=-1
+    plddt_b_factors = np.broadcast_to(
+        plddt[..., None], plddt.shape + (residue_constants.atom_type_num,)
     )
     # TODO: , may need to reorder chains, based on entity_ids
     cur_protein = protein.from_prediction(
-        features=batch, result=out, b_factors=plddt_b_factors
+        features=best_batch, result=out, b_factors=plddt_b_factors
     )
 
     iptm_str = np.mean(out["iptm+ptm"])
@@ -330,17 +652,14 @@ def main(args):
         ptms[cur_save_name] = str(np.mean(out["iptm+ptm"]))
 
     if args.relax:
-        amber_relaxer = relax.AmberRelaxation(
-            max_iterations=RELAX_MAX_ITERATIONS,
-            tolerance=RELAX_ENERGY_TOLERANCE,
-            stiffness=RELAX_STIFFNESS,
-            exclude_residues=RELAX_EXCLUDE_RESIDUES,
-            max_outer_iterations=RELAX_MAX_OUTER_ITERATIONS,
-            use_gpu=True)
-
-        relaxed_pdb_str, _, violations = amber_relaxer.process(
-            prot=cur_protein)
-
+        if relax_job is not None and relax_job[0] is best_relax_protein:
+            relaxed_pdb_str = relax_job[1].get()
+        else:
+            # the CPU worker never got to the final best, the GPU is free now
+            relaxed_pdb_str = relax_prediction(cur_protein, use_gpu=True)
+        if relax_pool is not None:
+            # also stops a superseded relaxation that is still running
+            relax_pool.terminate()
 
         with open(os.path.join(output_dir, cur_save_name + '_best.pdb'), "w") as f:
             f.write(relaxed_pdb_str)
@@ -349,11 +668,13 @@ def main(args):
     print("plddts", plddts)
     score_name = f"{args.model_name}_{cur_param_path_postfix}_{args.data_random_seed}_{args.times}{name_postfix}"
     plddt_fname = score_name + "_plddt.json"
-    json.dump(plddts, open(os.path.join(output_dir, plddt_fname), "w"), indent=4)
+    with open(os.path.join(output_dir, plddt_fname), "w") as f:
+        json.dump(plddts, f, indent=4)
     if ptms:
         print("ptms", ptms)
         ptm_fname = score_name + "_ptm.json"
-        json.dump(ptms, open(os.path.join(output_dir, ptm_fname), "w"), indent=4)
+        with open(os.path.join(output_dir, ptm_fname), "w") as f:
+            json.dump(ptms, f, indent=4)
 
 
 if __name__ == "__main__":
@@ -434,7 +755,24 @@ if __name__ == "__main__":
     parser.add_argument("--use_uniprot", action="store_true")
     parser.add_argument("--relax", action="store_true")
     parser.add_argument("--bf16", action="store_true")
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default="none",
+        choices=["none", "int8wo", "autoquant", "fp8"],
+        help="Quantize the model weights with torchao",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Compile the model with torch.compile; the first prediction pays the compilation cost",
+    )
     parser.add_argument("--save_raw_output", action="store_true")
+    parser.add_argument(
+        "--save_all_models",
+        action="store_true",
+        help="Write the unrelaxed PDB of every sample instead of only the best one",
+    )
     parser.add_argument(
     "--rdc_path",
     type=str,
@@ -0,0 +1,85 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("unicore")
+
+from unicore.modules import softmax_dropout
+from unifold.modules.attentions import Attention, SDPA_FLOAT_MASK, gen_attn_mask
+
+requires_sdpa = pytest.mark.skipif(
+    not hasattr(torch.nn.functional, "scaled_dot_product_attention"),
+    reason="requires torch.nn.functional.scaled_dot_product_attention",
+)
+requires_cuda_sdpa = pytest.mark.skipif(
+    not (SDPA_FLOAT_MASK and torch.cuda.is_available()),
+    reason="the SDPA path is only taken on cuda with torch >= 2.1",
+)
+
+
+def make_attention(dim, num_heads, device="cpu"):
+    attn = Attention(dim, dim, dim, dim // num_heads, num_heads, use_flash_attn=True)
+    # the default init zeroes the output projection
+    for p in attn.parameters():
+        torch.nn.init.normal_(p, std=0.5)
+    return attn.to(device).eval()
+
+
+def make_mask_and_bias(batch, num_seq, num_res, num_heads, use_mask, use_bias, device="cpu"):
+    mask = bias = None
+    if use_mask:
+        seq_mask = (torch.rand(batch, num_seq, 1, 1, num_res, device=device) > 0.3).float()
+        seq_mask[..., 0] = 1.0  # keep at least one key per row
+        mask = gen_attn_mask(seq_mask, -1e9)
+    if use_bias:
+        bias = torch.randn(batch, 1, num_heads, num_res, num_res, device=device)
+    return mask, bias
+
+
+@requires_sdpa
+@pytest.mark.parametrize("use_mask,use_bias", [(True, True), (True, False), (False, True)])
+def test_sdpa_forward_matches_softmax_dropout(use_mask, use_bias):
+    torch.manual_seed(0)
+    batch, num_seq, num_res, head_dim, num_heads = 2, 3, 7, 4, 4
+    attn = make_attention(head_dim * num_heads, num_heads)
+    q, k, v = (
+        torch.randn(batch, num_seq, num_heads, num_res, head_dim) for _ in range(3)
+    )
+    mask, bias = make_mask_and_bias(batch, num_seq, num_res, num_heads, use_mask, use_bias)
+
+    logits = torch.matmul(q * attn.norm, k.transpose(-1, -2))
+    expected = torch.matmul(softmax_dropout(logits, 0, False, mask=mask, bias=bias), v)
+    actual = attn._sdpa_forward(q, k, v, mask, bias)
+
+    assert actual.shape == expected.shape
+    torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-4)
+
+
+def run_attention(attn, x, mask, bias, inference):
+    attn.inference = inference
+    with torch.no_grad():
+        return attn(x, x, x, mask=mask, bias=bias)
+
+
+@requires_cuda_sdpa
+def test_sdpa_path_matches_and_peak_memory_on_cuda():
+    torch.manual_seed(0)
+    batch, num_seq, num_res, dim, num_heads = 1, 8, 256, 64, 4
+    attn = make_attention(dim, num_heads, device="cuda")
+    x = torch.randn(batch, num_seq, num_res, dim, device="cuda")
+    mask, bias = make_mask_and_bias(
+        batch, num_seq, num_res, num_heads, True, True, device="cuda"
+    )
+
+    peaks = {}
+    outputs = {}
+    for inference in (False, True):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        start = torch.cuda.memory_allocated()
+        outputs[inference] = run_attention(attn, x, mask, bias, inference)
+        torch.cuda.synchronize()
+        peaks[inference] = torch.cuda.max_memory_allocated() - start
+
+    torch.testing.assert_close(outputs[True], outputs[False], rtol=1e-3, atol=1e-3)
+    # the merged mask is the only logits-sized tensor of the SDPA path
+    assert peaks[True] <= peaks[False]
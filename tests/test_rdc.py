@@ -0,0 +1,114 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+inference = pytest.importorskip("inference")
+
+from unifold.data import residue_constants as rc
+
+N_IDX = rc.atom_order["N"]
+CA_IDX = rc.atom_order["CA"]
+C_IDX = rc.atom_order["C"]
+
+
+def make_rdcs(res_idx, a1_idx, a2_idx, values):
+    return inference.RDCs(
+        res_idx=np.array(res_idx, dtype=np.int64),
+        a1_idx=np.array(a1_idx, dtype=np.int64),
+        a2_idx=np.array(a2_idx, dtype=np.int64),
+        values=np.array(values, dtype=np.float64),
+    )
+
+
+def make_coords(num_res=2):
+    coords = np.zeros((num_res, rc.atom_type_num, 3), dtype=np.float32)
+    coords[:, CA_IDX] = [0.0, 0.0, 1.0]  # N-CA along z
+    coords[:, C_IDX] = [1.0, 0.0, 1.0]  # CA-C along x
+    return coords
+
+
+@pytest.fixture(params=["numpy", "numba"])
+def q_factor_backend(request, monkeypatch):
+    if request.param == "numpy":
+        monkeypatch.setattr(inference, "HAS_NUMBA", False)
+    elif not inference.HAS_NUMBA:
+        pytest.skip("numba is not installed")
+    return request.param
+
+
+def test_q_factor(q_factor_backend):
+    rdcs = make_rdcs([0, 1], [N_IDX, CA_IDX], [CA_IDX, C_IDX], [1.0, 0.5])
+    # predicted couplings are [1, 0]
+    expected = 0.5 / np.sqrt(1.25)
+    assert inference.compute_q_factor(make_coords(), rdcs) == pytest.approx(expected)
+
+
+def test_q_factor_skips_out_of_range_residues(q_factor_backend):
+    coords = make_coords()
+    rdcs = make_rdcs(
+        [-1, 2, 0], [N_IDX, N_IDX, CA_IDX], [CA_IDX, CA_IDX, C_IDX], [3.0, 3.0, 0.5]
+    )
+    only_valid = make_rdcs([0], [CA_IDX], [C_IDX], [0.5])
+    assert inference.compute_q_factor(coords, rdcs) == pytest.approx(
+        inference.compute_q_factor(coords, only_valid)
+    )
+
+
+def test_q_factor_without_matching_rdcs_is_inf(q_factor_backend):
+    rdcs = make_rdcs([-1, 5], [N_IDX, N_IDX], [CA_IDX, CA_IDX], [1.0, 1.0])
+    assert inference.compute_q_factor(make_coords(), rdcs) == np.inf
+
+
+def test_q_factor_zero_length_bond_is_inf(q_factor_backend):
+    # N and CB both sit at the origin
+    rdcs = make_rdcs([0], [N_IDX], [rc.atom_order["CB"]], [1.0])
+    assert inference.compute_q_factor(make_coords(), rdcs) == np.inf
+
+
+def test_q_factor_all_zero_values_is_inf(q_factor_backend):
+    rdcs = make_rdcs([0, 1], [N_IDX, CA_IDX], [CA_IDX, C_IDX], [0.0, 0.0])
+    assert inference.compute_q_factor(make_coords(), rdcs) == np.inf
+
+
+@pytest.mark.skipif(not inference.HAS_NUMBA, reason="numba is not installed")
+def test_q_factor_numba_matches_numpy(monkeypatch):
+    rng = np.random.default_rng(0)
+    num_res, num_rdcs = 20, 50
+    coords = rng.normal(size=(num_res, rc.atom_type_num, 3)).astype(np.float32)
+    rdcs = make_rdcs(
+        rng.integers(-2, num_res + 2, size=num_rdcs),
+        rng.integers(0, rc.atom_type_num, size=num_rdcs),
+        rng.integers(0, rc.atom_type_num, size=num_rdcs),
+        rng.normal(size=num_rdcs),
+    )
+    numba_q = inference.compute_q_factor(coords, rdcs)
+    monkeypatch.setattr(inference, "HAS_NUMBA", False)
+    numpy_q = inference.compute_q_factor(coords, rdcs)
+    assert np.isfinite(numba_q)
+    assert numba_q == pytest.approx(numpy_q, rel=1e-5)
+
+
+def test_load_rdc_file(tmp_path):
+    path = tmp_path / "rdcs.tsv"
+    path.write_text(
+        "residue\tatom1\tatom2\tvalue\n"  # header
+        "\n"
+        "1\tN\tCA\t1.5\n"
+        "2\tN\tCA\tnan\n"
+        "3\tN\tCA\tabc\n"
+        "x\tN\tCA\t1.0\n"
+        "4\tN\tH\t1.0\n"  # no hydrogens in atom37
+        "5\tCA\tC\t-2.0\n"
+        "0\tN\tCA\t0.5\n"  # kept, skipped when scoring
+    )
+    rdcs = inference.load_rdc_file(str(path))
+    np.testing.assert_array_equal(rdcs.res_idx, [0, 4, -1])
+    np.testing.assert_array_equal(rdcs.a1_idx, [N_IDX, CA_IDX, N_IDX])
+    np.testing.assert_array_equal(rdcs.a2_idx, [CA_IDX, C_IDX, CA_IDX])
+    np.testing.assert_array_equal(rdcs.values, [1.5, -2.0, 0.5])
+    assert rdcs.res_idx.dtype == np.int64
+    assert rdcs.values.dtype == np.float64
+
+
+def test_load_rdc_file_missing(tmp_path):
+    with pytest.raises(ValueError):
+        inference.load_rdc_file(str(tmp_path / "missing.tsv"))
@@ -257,27 +257,38 @@ def load(
     all_chain_features['xl'] = xl
 
     if neff > 0:
-        before = all_chain_features['msa'].shape[0]
-        indices = subsample_msa_sequentially(all_chain_features['msa'],neff=neff)
-        all_chain_features['msa'] = all_chain_features['msa'][indices]
-        all_chain_features["deletion_matrix"] = all_chain_features["deletion_matrix"][indices]
-        all_chain_features['msa_mask'] = all_chain_features['msa_mask'][indices]
-        after = all_chain_features['msa'].shape[0]
-        print("Downsampling MSAs to Neff %d: size of MSA before %d, now %d" % (neff, before, after))
+        all_chain_features = subsample_msa_to_neff(all_chain_features, neff)
 
     if dropout_crosslinks > 0:
-        links = torch.nonzero(torch.from_numpy(xl[:,:,0]))
-        for i,j in links:
-            i = i.item()
-            j = j.item()
-            all_chain_features['msa'][1:,i] = 21
-            all_chain_features["deletion_matrix"][1:,i] = 0
-            all_chain_features['msa'][1:,j] = 21
-            all_chain_features["deletion_matrix"][1:,j] = 0
+        all_chain_features = dropout_crosslinked_msa(all_chain_features)
 
     return all_chain_features, None
 
 
+def subsample_msa_to_neff(features: NumpyDict, neff: int) -> NumpyDict:
+    before = features['msa'].shape[0]
+    indices = subsample_msa_sequentially(features['msa'],neff=neff)
+    features['msa'] = features['msa'][indices]
+    features["deletion_matrix"] = features["deletion_matrix"][indices]
+    features['msa_mask'] = features['msa_mask'][indices]
+    after = features['msa'].shape[0]
+    print("Downsampling MSAs to Neff %d: size of MSA before %d, now %d" % (neff, before, after))
+    return features
+
+
+def dropout_crosslinked_msa(features: NumpyDict) -> NumpyDict:
+    # mask out all but the query sequence at crosslinked positions
+    links = torch.nonzero(torch.from_numpy(features['xl'][:,:,0]))
+    for i,j in links:
+        i = i.item()
+        j = j.item()
+        features['msa'][1:,i] = 21
+        features["deletion_matrix"][1:,i] = 0
+        features['msa'][1:,j] = 21
+        features["deletion_matrix"][1:,j] = 0
+    return features
+
+
 def process(
     config: mlc.ConfigDict,
     mode: str,
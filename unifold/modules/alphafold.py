@@ -399,12 +399,16 @@ class AlphaFold(nn.Module):
             outputs["delta_pair"] = delta_pair
             outputs["msa_norm_mask"] = msa_mask
 
-        outputs["sm"] = self.structure_module(
-            s,
-            z,
-            feats["aatype"],
-            mask=feats["seq_mask"],
-        )
+        # the structure module stays in its parameter dtype under autocast,
+        # the frame updates are too sensitive for bf16 linears
+        sm_dtype = next(self.structure_module.parameters()).dtype
+        with torch.autocast(device_type=s.device.type, enabled=False):
+            outputs["sm"] = self.structure_module(
+                s.to(sm_dtype),
+                z.to(sm_dtype),
+                feats["aatype"],
+                mask=feats["seq_mask"],
+            )
         outputs["final_atom_positions"] = atom14_to_atom37(
             outputs["sm"]["positions"], feats
         )
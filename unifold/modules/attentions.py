@@ -2,6 +2,7 @@ from functools import partialmethod
 from typing import Optional, List
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from .common import Linear, chunk_layer
 from unicore.utils import (
     permute_final_dims,
@@ -12,6 +13,14 @@ from unicore.modules import (
 )
 
 
+# the memory-efficient SDPA kernel takes an additive float mask only on cuda from
+# torch 2.1 on; otherwise SDPA runs the math backend, which holds the logits, the
+# probabilities and the merged mask at once, more than softmax_dropout needs
+SDPA_FLOAT_MASK = (
+    hasattr(F, "scaled_dot_product_attention") and torch.__version__ >= "2.1"
+)
+
+
 def gen_attn_mask(mask, neg_inf):
     assert neg_inf < -1e4
     attn_mask = torch.zeros_like(mask)
@@ -62,9 +71,18 @@ class Attention(nn.Module):
             # gating, use raw query input
             g = self.linear_g(q)
 
+        use_sdpa = (
+            self.use_flash_attn
+            and getattr(self, "inference", False)
+            and SDPA_FLOAT_MASK
+            and q.is_cuda
+        )
+
         # [bs, seq, n, c] -> [bs, seq, n, no_heads * c] -> [bs, seq, n, no_heads, c]
         q = self.linear_q(q)
-        q *= self.norm
+        if not use_sdpa:
+            # the fused kernels apply the same 1/sqrt(head_dim) by default
+            q *= self.norm
         k = self.linear_k(k)
         v = self.linear_v(v)
 
@@ -72,12 +90,16 @@ class Attention(nn.Module):
         k = k.view(k.shape[:-1] + (self.num_heads, -1)).transpose(-2, -3).contiguous()
         v = v.view(v.shape[:-1] + (self.num_heads, -1)).transpose(-2, -3)
 
-        attn = torch.matmul(q, k.transpose(-1, -2))
-        del q, k
+        if use_sdpa:
+            o = self._sdpa_forward(q, k, v, mask, bias)
+            del q, k, v
+        else:
+            attn = torch.matmul(q, k.transpose(-1, -2))
+            del q, k
 
-        attn = softmax_dropout(attn, 0, self.training, mask=mask, bias=bias)
-        o = torch.matmul(attn, v)
-        del attn, v
+            attn = softmax_dropout(attn, 0, self.training, mask=mask, bias=bias)
+            o = torch.matmul(attn, v)
+            del attn, v
 
         o = o.transpose(-2, -3).contiguous()
 
@@ -90,6 +112,32 @@ class Attention(nn.Module):
         o = nn.functional.linear(o, self.linear_o.weight)
         return o
 
+    def _sdpa_forward(self, q, k, v, mask=None, bias=None):
+        # the kernel never materializes the logits or probabilities, but mask and
+        # bias are merged into one logits-sized tensor in the compute dtype, so the
+        # peak per chunk matches the single logits tensor of softmax_dropout
+        if mask is not None:
+            mask = mask.type(q.dtype)
+        if bias is not None:
+            bias = bias.type(q.dtype)
+        if mask is not None and bias is not None:
+            attn_mask = mask + bias
+        else:
+            attn_mask = mask if mask is not None else bias
+        # fused kernels take [B, H, N, C], flatten the leading dims
+        batch_dims = q.shape[:-3]
+        q = q.reshape(-1, *q.shape[-3:])
+        k = k.reshape(-1, *k.shape[-3:])
+        v = v.reshape(-1, *v.shape[-3:])
+        if attn_mask is not None:
+            # a view if the broadcast leading dims are size 1 or the mask is
+            # already full size, otherwise this copies the mask to full size
+            attn_mask = attn_mask.expand(
+                *batch_dims, *attn_mask.shape[-3:]
+            ).reshape(-1, *attn_mask.shape[-3:])
+        o = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+        return o.view(*batch_dims, *o.shape[-3:])
+
     def get_output_bias(self):
         return self.linear_o.bias
 
@@ -73,11 +73,14 @@ class Rotation:
 
     @staticmethod
     def mat_mul_mat(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
-        return (a.float() @ b.float()).type(a.dtype)
+        # autocast would otherwise run the matmul in low precision again
+        with torch.autocast(device_type=a.device.type, enabled=False):
+            return (a.float() @ b.float()).type(a.dtype)
 
     @staticmethod
     def mat_mul_vec(r: torch.Tensor, t: torch.Tensor) -> torch.Tensor:
-        return (r.float() @ t.float().unsqueeze(-1)).squeeze(-1).type(t.dtype)
+        with torch.autocast(device_type=r.device.type, enabled=False):
+            return (r.float() @ t.float().unsqueeze(-1)).squeeze(-1).type(t.dtype)
 
     def __getitem__(self, index: Any) -> Rotation:
         if not isinstance(index, tuple):